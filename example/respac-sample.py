@@ -1,28 +1,25 @@
-import os
 import sys
-import requests
 
 sys.path.append("../")
 sys.dont_write_bytecode = True
 
 from respac import Respac
+from pdb_prefetch import PDBMirror
 
 
-def fetch_pdb(pdb_name, out_dir):
-    
-    target_url = 'https://files.rcsb.org/download/' + pdb_name + '.pdb'
-    req_pdb = requests.get(target_url)
+def fetch_pdb(pdb_names, out_dir, mirror_dir = '../pdb_mirror'):
 
-    os.system('mkdir -p ' + out_dir)
-    pdb = open(out_dir + '/' + pdb_name + '.pdb', 'w')
-    pdb.write(req_pdb.text)
-    pdb.close()
+    # Entries already in the mirror are not downloaded again
+    mirror = PDBMirror(mirror_dir)
+    mirror.prefetch(pdb_names)
+    for pdb_name in pdb_names:
+        mirror.export(pdb_name, out_dir)
     
 
 
 def main():
 
-    fetch_pdb('2igd', '../pdb_protein')
+    fetch_pdb(['2igd'], '../pdb_protein')
 
     # pdb_dir, out_dir, template_dir are optional arguments
     x = Respac('2igd', pdb_dir = '../pdb_protein', out_dir = '.', template_dir = '../lib/template')
@@ -30,12 +27,14 @@ def main():
     # respac.py assumes $PATH to the programs has already been set.
     # If not, you can specify path and commands as follows:
     
-    # x.pqr_exe        = "path/to/pdb2pqr30 "                                         # default "pdb2pqr30 "
-    # x.apbs_exe       = "path/to/APBS-3.0.0.Linux/bin/apbs "                         # default "apbs "
-    # x.dxmath_exe     = "path/to/APBS-3.0.0.Linux/share/apbs/tools/dxmath "          # default "dxmath "
-    # x.surface_exe    = "path/to/cafemol_3.2.1/utility/RESPAC/surface/bin/surface "  # default "surface "
-    # x.pdcp_exe       = "path/to/cafemol_3.2.1/utility/RESPAC/pdcp/bin/pdcp "        # default "pdcp "
-    # x.env_ldlib_path = "export LD_LIBRARY_PATH=/path/to/APBS-3.0.0.Linux/lib/:/usr/local/lib/:/usr/lib/:$LD_LIBRARY_PATH; "
+    # x.pqr_exe         = "path/to/pdb2pqr30"                                         # default "pdb2pqr30"
+    # x.apbs_exe        = "path/to/APBS-3.0.0.Linux/bin/apbs"                         # default "apbs"
+    # x.dxmath_exe      = "path/to/APBS-3.0.0.Linux/share/apbs/tools/dxmath"          # default "dxmath"
+    # x.surface_exe     = "path/to/cafemol_3.2.1/utility/RESPAC/surface/bin/surface"  # default "surface"
+    # x.pdcp_exe        = "path/to/cafemol_3.2.1/utility/RESPAC/pdcp/bin/pdcp"        # default "pdcp"
+    # x.ld_library_path = "/path/to/APBS-3.0.0.Linux/lib/:/usr/local/lib/:/usr/lib/"  # prepended to $LD_LIBRARY_PATH
+    # Paths may contain spaces; extra arguments of a program go to *_exe_args, e.g.
+    # x.pqr_exe_args    = ["--nodebump"]                                             # default []
 
     
     # You can change several conditions
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import gzip
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# -------------------- Defaults ------------------------------
+base_url   = "https://files.rcsb.org/download"
+mirror_dir = "./pdb_mirror"
+n_workers  = 8
+n_retries  = 3
+timeout    = 60.0
+
+
+def write_atomic(filename, data):
+    # Write via a temporary file so that concurrent readers never see a partial file
+    out_dir = os.path.dirname(filename) or '.'
+    fd, tmp_name = tempfile.mkstemp(dir = out_dir, prefix = '.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            fout.write(data)
+        os.replace(tmp_name, filename)
+    except:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+
+class PDBMirror:
+    """Local content-addressed mirror of PDB entries.
+
+    Entries are stored gzip-compressed as objects/<sha256[:2]>/<sha256>.pdb.gz,
+    where the hash is taken over the uncompressed PDB file, and ids/<id>
+    holds the hash of each entry. An entry already in the mirror is never
+    downloaded again, so one mirror can be shared by later runs and workers.
+    """
+
+    def __init__(self, mirror_dir = mirror_dir, base_url = base_url, compressed = True):
+        self.mirror_dir = mirror_dir
+        self.base_url   = base_url.rstrip('/')
+        self.compressed = compressed   # download <id>.pdb.gz instead of <id>.pdb
+
+        self.n_workers = n_workers
+        self.n_retries = n_retries
+        self.timeout   = timeout
+
+        self.obj_dir = mirror_dir + '/objects'
+        self.ids_dir = mirror_dir + '/ids'
+
+
+    def init(self):
+        os.makedirs(self.obj_dir, exist_ok = True)
+        os.makedirs(self.ids_dir, exist_ok = True)
+
+
+    def make_session(self):
+        # One session whose connection pool is shared by all download threads
+        retry = Retry(total = self.n_retries, backoff_factor = 0.5,
+                      status_forcelist = [429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = self.n_workers, max_retries = retry)
+        session = requests.Session()
+        session.mount('http://',  adapter)
+        session.mount('https://', adapter)
+        return session
+
+
+    # --------------------------------------------------------------------------------
+    # Mirror lookup
+
+    def object_name(self, digest):
+        return self.obj_dir + '/' + digest[:2] + '/' + digest + '.pdb.gz'
+
+
+    def id_name(self, pdb_id):
+        return self.ids_dir + '/' + pdb_id.lower()
+
+
+    def lookup(self, pdb_id):
+        # Path of the mirrored object of pdb_id, or None if not mirrored
+        id_name = self.id_name(pdb_id)
+        if not os.path.exists(id_name):
+            return None
+        with open(id_name, 'r') as fin:
+            obj_name = self.object_name(fin.read().strip())
+        if not os.path.exists(obj_name):
+            return None
+        return obj_name
+
+
+    def read(self, pdb_id):
+        # Uncompressed contents of pdb_id as bytes, or None if not mirrored
+        obj_name = self.lookup(pdb_id)
+        if obj_name is None:
+            return None
+        with gzip.open(obj_name, 'rb') as fin:
+            return fin.read()
+
+
+    def store(self, pdb_id, data):
+        digest   = hashlib.sha256(data).hexdigest()
+        obj_name = self.object_name(digest)
+        if not os.path.exists(obj_name):
+            os.makedirs(os.path.dirname(obj_name), exist_ok = True)
+            write_atomic(obj_name, gzip.compress(data))
+        write_atomic(self.id_name(pdb_id), digest.encode())
+        return obj_name
+
+
+    # --------------------------------------------------------------------------------
+    # Download
+
+    def download(self, session, pdb_id):
+        if self.compressed:
+            target_url = self.base_url + '/' + pdb_id + '.pdb.gz'
+        else:
+            target_url = self.base_url + '/' + pdb_id + '.pdb'
+
+        try:
+            req_pdb = session.get(target_url, timeout = self.timeout)
+            req_pdb.raise_for_status()
+            data = req_pdb.content
+            if data[:2] == b'\x1f\x8b':
+                data = gzip.decompress(data)
+        except Exception as e:
+            print(" !!! ERROR: Failed to download {}: {}".format(target_url, e))
+            return None
+
+        return self.store(pdb_id, data)
+
+
+    def prefetch(self, pdb_ids):
+        # Download all entries not yet mirrored; returns {pdb_id: object path or None}
+        self.init()
+
+        result  = {}
+        missing = []
+        missing_lower = set()
+        for pdb_id in pdb_ids:
+            obj_name = self.lookup(pdb_id)
+            if obj_name is None and pdb_id.lower() not in missing_lower:
+                missing.append(pdb_id)
+                missing_lower.add(pdb_id.lower())
+            result[pdb_id] = obj_name
+
+        print(" {} entries to download into mirror {}".format(len(missing), self.mirror_dir))
+        if not missing:
+            return result
+
+        with self.make_session() as session:
+            with ThreadPoolExecutor(max_workers = self.n_workers) as pool:
+                obj_names = list(pool.map(lambda pdb_id: self.download(session, pdb_id), missing))
+
+        for pdb_id, obj_name in zip(missing, obj_names):
+            result[pdb_id] = obj_name
+        for pdb_id in result:
+            if result[pdb_id] is None:
+                result[pdb_id] = self.lookup(pdb_id)
+
+        n_failed = sum(1 for obj_name in obj_names if obj_name is None)
+        print(" Downloaded {} entries, {} failed".format(len(missing) - n_failed, n_failed))
+        return result
+
+
+    def export(self, pdb_id, pdb_dir):
+        # Place <pdb_dir>/<pdb_id>.pdb from the mirror unless it already exists
+        pdb_name = pdb_dir + '/' + pdb_id + '.pdb'
+        if os.path.exists(pdb_name):
+            return pdb_name
+
+        data = self.read(pdb_id)
+        if data is None:
+            print(" !!! ERROR: {} is not in mirror {}".format(pdb_id, self.mirror_dir))
+            return None
+
+        os.makedirs(pdb_dir, exist_ok = True)
+        write_atomic(pdb_name, data)
+        return pdb_name
+
+
+
+def main(id_list, pdb_dir = None, mirror = mirror_dir):
+    with open(id_list, 'r') as fin:
+        pdb_ids = [line.split()[0] for line in fin if line.strip() and not line.startswith('#')]
+
+    x = PDBMirror(mirror)
+    x.prefetch(pdb_ids)
+    if pdb_dir is not None:
+        for pdb_id in pdb_ids:
+            x.export(pdb_id, pdb_dir)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or len(sys.argv) > 4:
+        print("Usage: python3 pdb_prefetch.py id_list [pdb_dir] [mirror_dir]")
+    else:
+        main(*sys.argv[1:])
@@ -3,15 +3,20 @@
 import os
 import re
 import sys
+import glob
+import shlex
+import shutil
+import subprocess
+import threading
 
 
 # -------------------- Commands & Paths ---------------------
-pqr_exe     = "pdb2pqr30 "
-apbs_exe    = "apbs "
-dxmath_exe  = "dxmath "
-surface_exe = "surface "
-pdcp_exe    = "pdcp "
-env_ldlib_path = "export LD_LIBRARY_PATH=/usr/local/lib/:/usr/lib/:$LD_LIBRARY_PATH; "
+pqr_exe     = "pdb2pqr30"
+apbs_exe    = "apbs"
+dxmath_exe  = "dxmath"
+surface_exe = "surface"
+pdcp_exe    = "pdcp"
+ld_library_path = "/usr/local/lib/:/usr/lib/"   # prepended to $LD_LIBRARY_PATH of the programs
 
 
 # -------------------- Defaults of Basic Variables ----------
@@ -20,6 +25,58 @@ apbs_box_margin = 20.0
 apbs_grid_size  = 0.45
 apbs_radius_A   = 3.0
 apbs_radius_B   = 12.0
+surface_dbox    = 6.0
+surface_r_probe = 4.0
+n_threads       = None    # None: keep OMP_NUM_THREADS of the environment, CPU 1 for pdcp
+
+# -------------------- Defaults of Adaptive Grid -------------
+adaptive_grid_sizes = [1.0, 0.8, 0.6, 0.45]   # coarse to fine [Angstrom]
+adaptive_charge_tol = 0.02                    # max change of residue charges between levels
+
+
+# -------------------- Thread budget -------------------------
+class ThreadBudget:
+    """Share the cores of a node among concurrently running Respac jobs.
+
+    n_total, the number of jobs in the batch, is required: the n_cores
+    cores are split among min(n_jobs, jobs not yet finished) jobs, or
+    among the threaded stages actually running if there are more of them.
+    Each stage takes its share when it starts, so as jobs finish the
+    remaining ones get more cores, and the last job gets all of them.
+    """
+
+    def __init__(self, n_total, n_cores = None, n_jobs = 1):
+        self.n_total  = max(1, n_total)
+        self.n_cores  = n_cores if n_cores else (os.cpu_count() or 1)
+        self.n_jobs   = max(1, n_jobs)
+        self.n_done   = 0
+        self.n_active = 0
+        self.lock     = threading.Lock()
+
+
+    def share(self):
+        n_split = min(self.n_jobs, self.n_total - self.n_done)
+        n_split = max(n_split, self.n_active, 1)
+        return max(1, self.n_cores // n_split)
+
+
+    def acquire(self):
+        # Called when a threaded stage (APBS, pdcp) starts
+        with self.lock:
+            self.n_active += 1
+            return self.share()
+
+
+    def release(self):
+        # Called when a threaded stage finishes
+        with self.lock:
+            self.n_active = max(0, self.n_active - 1)
+
+
+    def finish_job(self):
+        # Called when a whole Respac job finishes
+        with self.lock:
+            self.n_done += 1
 
 
 class Respac:
@@ -32,7 +89,16 @@ class Respac:
         self.dxmath_exe  = dxmath_exe
         self.surface_exe = surface_exe
         self.pdcp_exe    = pdcp_exe
-        self.env_ldlib_path = env_ldlib_path
+
+        # Extra arguments placed right after each program (the *_exe paths
+        # are never split, so they may contain spaces)
+        self.pqr_exe_args     = []
+        self.apbs_exe_args    = []
+        self.dxmath_exe_args  = []
+        self.surface_exe_args = []
+        self.pdcp_exe_args    = []
+        self.ld_library_path = ld_library_path
+        self.env_ldlib_path  = None   # deprecated "export LD_LIBRARY_PATH=...; " prefix, read if set
 
         # Set filenames
         self.pdb_dir         = pdb_dir
@@ -46,9 +112,11 @@ class Respac:
         self.apbs_out_name   = out_dir + '/run/apbs_out/' + pro_name + '_apbs_potential.dx'
         self.volm_out_name   = out_dir + '/run/apbs_out/' + pro_name + '_delta_volm.dx'
         self.apbs_io_mc      = out_dir + '/run/apbs_out/' + 'io.mc'
+        self.apbs_work_dir   = out_dir + '/run/apbs_out'
         self.surf_name       = out_dir + '/run/surf_in/'  + pro_name + '.surf'
         self.pdc_name        = out_dir + '/run/pdc_in/'   + pro_name + '.pdcin'
         self.charge_name     = out_dir + '/results/'      + pro_name + '.charge'
+        self.grid_log_name   = out_dir + '/results/'      + pro_name + '.grid'
 
         # Template files
         self.apbs_in_template     = template_dir + '/apbs_in_template'
@@ -62,6 +130,19 @@ class Respac:
         self.apbs_grid_size  = apbs_grid_size
         self.apbs_radius_A   = apbs_radius_A
         self.apbs_radius_B   = apbs_radius_B
+        self.surface_dbox    = surface_dbox
+        self.surface_r_probe = surface_r_probe
+
+        # Adaptive grid
+        self.adaptive_grid_sizes = list(adaptive_grid_sizes)
+        self.adaptive_charge_tol = adaptive_charge_tol
+        self.adaptive_grid_size  = None    # chosen spacing, None if all levels failed
+        self.adaptive_residual   = None
+        self.adaptive_converged  = False
+
+        # Threads for APBS, dxmath, surface and pdcp
+        self.n_threads    = n_threads
+        self.thread_budget = None
 
         self.verbose = False
 
@@ -71,13 +152,8 @@ class Respac:
 
     def init(self):
         # Make output directory
-        os.system('mkdir -p ' + self.out_dir + '/run/pqr')
-        os.system('mkdir -p ' + self.out_dir + '/run/apbs_in')
-        os.system('mkdir -p ' + self.out_dir + '/run/apbs_out')
-        os.system('mkdir -p ' + self.out_dir + '/run/surf_in')
-        os.system('mkdir -p ' + self.out_dir + '/run/pdc_in')
-        os.system('mkdir -p ' + self.out_dir + '/run/pdb')
-        os.system('mkdir -p ' + self.out_dir + '/results')
+        for sub_dir in ['/run/pqr', '/run/apbs_in', '/run/apbs_out', '/run/surf_in', '/run/pdc_in', '/run/pdb', '/results']:
+            os.makedirs(self.out_dir + sub_dir, exist_ok = True)
     
 
     def show_basic_settings(self):
@@ -92,6 +168,83 @@ class Respac:
         print(" APBS grid size = {}".format(self.apbs_grid_size))
         print(" APBS radius A  = {}".format(self.apbs_radius_A))
         print(" APBS radius B  = {}".format(self.apbs_radius_B))
+        print(" Surface dbox   = {}".format(self.surface_dbox))
+        print(" Surface probe  = {}".format(self.surface_r_probe))
+        if self.env_ldlib_path:
+            print(" !!! WARNING: env_ldlib_path is deprecated, use ld_library_path = \"{}\"".format(
+                self.parse_env_ldlib_path(self.env_ldlib_path)))
+        if self.thread_budget is not None:
+            print(" Threads        = shared, {} cores for {} of {} jobs".format(self.thread_budget.n_cores, self.thread_budget.n_jobs, self.thread_budget.n_total))
+        else:
+            print(" Threads        = {}".format(self.n_threads if self.n_threads else "environment"))
+
+
+    def command_env(self):
+        # Environment of the programs: library path and OpenMP/BLAS thread counts
+        env = dict(os.environ)
+        ld_library_path = self.ld_library_path
+        if self.env_ldlib_path:
+            ld_library_path = self.parse_env_ldlib_path(self.env_ldlib_path)
+        ld_paths = [p for p in [ld_library_path, env.get('LD_LIBRARY_PATH')] if p]
+        if ld_paths:
+            env['LD_LIBRARY_PATH'] = ':'.join(ld_paths)
+        if self.n_threads:
+            for key in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+                env[key] = str(self.n_threads)
+        return env
+
+
+    def parse_env_ldlib_path(self, env_ldlib_path):
+        # Library paths of an old-style "export LD_LIBRARY_PATH=a:b:$LD_LIBRARY_PATH; "
+        for part in env_ldlib_path.split(';'):
+            try:
+                words = shlex.split(part)
+            except ValueError:
+                continue
+            for word in words:
+                if word.startswith('LD_LIBRARY_PATH='):
+                    paths = word[len('LD_LIBRARY_PATH='):].split(':')
+                    return ':'.join(p for p in paths if p and p not in ['$LD_LIBRARY_PATH', '${LD_LIBRARY_PATH}'])
+        raise ValueError("Cannot read env_ldlib_path = {!r}; set ld_library_path "
+                         "(e.g. \"/path/to/lib/:/usr/lib/\") instead".format(env_ldlib_path))
+
+
+    def run_command(self, exe, args, log_name, cwd = None):
+        # Run exe without a shell, sending stdout and stderr to log_name
+        command = [exe.strip()] + [str(a) for a in args]
+        if self.verbose:
+            print(" ".join(shlex.quote(c) for c in command))
+        with open(log_name, 'w') as flog:
+            status = subprocess.call(command, stdout = flog, stderr = subprocess.STDOUT,
+                                     cwd = cwd, env = self.command_env())
+        if status != 0:
+            print(" !!! WARNING: {} exited with status {}, see {}".format(command[0], status, log_name))
+        return status
+
+
+    def begin_stage(self):
+        # Take a share of the thread budget for a threaded stage
+        if self.thread_budget is not None:
+            self.n_threads = self.thread_budget.acquire()
+            print(" Using {} threads".format(self.n_threads))
+
+
+    def end_stage(self):
+        if self.thread_budget is not None:
+            self.thread_budget.release()
+
+
+    def run_stage(self, *steps):
+        # Run steps with one share of the thread budget; stops and returns
+        # False as soon as a step returns False
+        self.begin_stage()
+        try:
+            for step in steps:
+                if step() is False:
+                    return False
+            return True
+        finally:
+            self.end_stage()
 
 
     def is_available(self, filename):
@@ -200,7 +353,7 @@ class Respac:
         with open(self.apbs_in_template) as fin_apbs_temp:
             for line in fin_apbs_temp:
                 new_line = line
-                new_line = re.sub('PQRFILE',        str(self.pqr_name),       new_line)
+                new_line = re.sub('PQRFILE',        str(os.path.abspath(self.pqr_name)), new_line)
                 new_line = re.sub('DIMX',           str(apbs_grid_n_x),       new_line)
                 new_line = re.sub('DIMY',           str(apbs_grid_n_y),       new_line)
                 new_line = re.sub('DIMZ',           str(apbs_grid_n_z),       new_line)
@@ -216,7 +369,7 @@ class Respac:
         with open(self.apbs_vol_in_template) as fin_apbs_vol_temp:
             for line in fin_apbs_vol_temp:
                 new_line = line
-                new_line = re.sub('PQRFILE',        str(self.pqr_name),       new_line)
+                new_line = re.sub('PQRFILE',        str(os.path.abspath(self.pqr_name)), new_line)
                 new_line = re.sub('DIMX',           str(apbs_grid_n_x),       new_line)
                 new_line = re.sub('DIMY',           str(apbs_grid_n_y),       new_line)
                 new_line = re.sub('DIMZ',           str(apbs_grid_n_z),       new_line)
@@ -234,7 +387,7 @@ class Respac:
         with open(self.apbs_vol_in_template) as fin_apbs_vol_temp:
             for line in fin_apbs_vol_temp:
                 new_line = line
-                new_line = re.sub('PQRFILE',        str(self.pqr_name),       new_line)
+                new_line = re.sub('PQRFILE',        str(os.path.abspath(self.pqr_name)), new_line)
                 new_line = re.sub('DIMX',           str(apbs_grid_n_x),       new_line)
                 new_line = re.sub('DIMY',           str(apbs_grid_n_y),       new_line)
                 new_line = re.sub('DIMZ',           str(apbs_grid_n_z),       new_line)
@@ -278,6 +431,7 @@ class Respac:
             for line in fin_pdc_temp:
                 new_line = line
                 new_line = re.sub('DEBYE', str(debye_length), new_line)
+                new_line = re.sub('NCPU',  str(self.n_threads if self.n_threads else 1), new_line)
                 fout_pdc_in.write(new_line)
         fout_pdc_in.close()
         
@@ -297,14 +451,11 @@ class Respac:
         # Check file
         self.is_available(self.pdb_tmp_name)
 
-        pqr_log = " > " + self.out_dir + "/run/PDB2PQR.log 2>&1"
-        pqr_command_args = "--ff=CHARMM --whitespace " + self.pdb_tmp_name + " " + self.pqr_name + pqr_log
-        pqr_command = self.pqr_exe + " " + pqr_command_args
+        pqr_log  = self.out_dir + "/run/PDB2PQR.log"
+        pqr_args = ["--ff=CHARMM", "--whitespace", self.pdb_tmp_name, self.pqr_name]
         
         try:
-            if self.verbose:
-                print(pqr_command)
-            os.system(pqr_command)
+            self.run_command(self.pqr_exe, self.pqr_exe_args + pqr_args, pqr_log)
         except:
             print(" !!! ERROR: pdb2pqr failed!")
             return
@@ -324,66 +475,72 @@ class Respac:
         self.is_available(self.apbs_vol_B_name)
 
 
+        # APBS and dxmath write fixed file names into the working directory,
+        # so they run in the apbs_out directory of this job.
+        work_dir = self.apbs_work_dir
+
+        # Clear outputs of an earlier run so that they are never taken as this run's
+        stale_names  = [os.path.join(work_dir, name) for name in ["io.mc", "apbs_potential.dx", "delta_vol.dx"]]
+        stale_names += glob.glob(os.path.join(glob.escape(work_dir), "vol_*.dx"))
+        stale_names += [self.apbs_out_name, self.volm_out_name]
+        for stale_name in stale_names:
+            if os.path.exists(stale_name):
+                os.remove(stale_name)
+
         print(" Step 1 of 3: APBS potentials...")
-        apbs_log = " > " + self.out_dir + "/run/APBS1.log 2>&1"
-        apbs_command = self.env_ldlib_path + self.apbs_exe + " " + self.apbs_name + apbs_log
+        apbs_log = self.out_dir + "/run/APBS1.log"
         try:
-            if self.verbose:
-                print(apbs_command)
-            os.system(apbs_command)
+            status = self.run_command(self.apbs_exe, self.apbs_exe_args + [os.path.abspath(self.apbs_name)], apbs_log, cwd = work_dir)
         except:
+            status = -1
+        if status != 0:
             print(" !!! ERROR: APBS calculation 1 failed!")
-            return
+            return False
         print(" Done... \n")
 
         print(" Step 2 of 3: APBS volume A...")
-        apbs_log = " > " + self.out_dir + "/run/APBS2.log 2>&1"
-        apbs_command = self.env_ldlib_path + self.apbs_exe + " " + self.apbs_vol_A_name + apbs_log
+        apbs_log = self.out_dir + "/run/APBS2.log"
         try:
-            if self.verbose:
-                print(apbs_command)
-            os.system(apbs_command)
+            status = self.run_command(self.apbs_exe, self.apbs_exe_args + [os.path.abspath(self.apbs_vol_A_name)], apbs_log, cwd = work_dir)
         except:
+            status = -1
+        if status != 0:
             print(" !!! ERROR: APBS calculation 2 failed!")
-            return
+            return False
         print(" Done... \n")
 
         print(" Step 3 of 3: APBS volume B...")
-        apbs_log = " > " + self.out_dir + "/run/APBS3.log 2>&1"
-        apbs_command = self.env_ldlib_path + self.apbs_exe + " " + self.apbs_vol_B_name + apbs_log
+        apbs_log = self.out_dir + "/run/APBS3.log"
         try:
-            if self.verbose:
-                print(apbs_command)
-            os.system(apbs_command)
+            status = self.run_command(self.apbs_exe, self.apbs_exe_args + [os.path.abspath(self.apbs_vol_B_name)], apbs_log, cwd = work_dir)
         except:
+            status = -1
+        if status != 0:
             print(" !!! ERROR: APBS calculation 3 failed!")
-            return
+            return False
         print(" Done... \n")
 
         print(" DXMATH calculating...")
-        dxmath_log     = " > " + self.out_dir + "/run/DXMATH.log 2>&1"
-        dxmath_command = self.env_ldlib_path + self.dxmath_exe + self.dxmath_template + dxmath_log
+        dxmath_log = self.out_dir + "/run/DXMATH.log"
         try:
-            if self.verbose:
-                print(dxmath_command)
-            os.system(dxmath_command)
+            status = self.run_command(self.dxmath_exe, self.dxmath_exe_args + [os.path.abspath(self.dxmath_template)], dxmath_log, cwd = work_dir)
         except:
+            status = -1
+        if status != 0:
             print(" !!! ERROR: dxmath calculation failed!")
-            return
+            return False
         print(" Done... ")
 
         # Move output files
-        mv_apbs_out_command = "mv apbs_potential.dx " + self.apbs_out_name
-        mv_volm_out_command = "mv delta_vol.dx "      + self.volm_out_name
-        mv_io_mc_command    = "mv io.mc "             + self.apbs_io_mc
         try:
-            os.system(mv_apbs_out_command)
-            os.system(mv_volm_out_command)
-            os.system(mv_io_mc_command)
-            os.system("rm -f vol_*.dx")
+            shutil.move(os.path.join(work_dir, "apbs_potential.dx"), self.apbs_out_name)
+            shutil.move(os.path.join(work_dir, "delta_vol.dx"),      self.volm_out_name)
+            for vol_name in glob.glob(os.path.join(glob.escape(work_dir), "vol_*.dx")):
+                os.remove(vol_name)
         except:
             print(" Something wrong with APBS claculations...")
-            return
+            return False
+        return True
 
         
     def run_surface(self):
@@ -395,14 +552,11 @@ class Respac:
         # Check files
         self.is_available(self.pqr_name)
 
-        surface_log = " > " + self.out_dir + "/run/SURFACE.log 2>&1"
-        surface_args1 = " --pqr " + self.pqr_name + " --ofname " + self.surf_name
-        surface_args2 = " --dbox 6.0 --r_probe 4.0 "
-        surface_command = self.env_ldlib_path + self.surface_exe + surface_args1 + surface_args2 + surface_log
+        surface_log   = self.out_dir + "/run/SURFACE.log"
+        surface_args1 = ["--pqr", self.pqr_name, "--ofname", self.surf_name]
+        surface_args2 = ["--dbox", self.surface_dbox, "--r_probe", self.surface_r_probe]
         try:
-            if self.verbose:
-                print(surface_command)
-            os.system(surface_command)
+            self.run_command(self.surface_exe, self.surface_exe_args + surface_args1 + surface_args2, surface_log)
         except:
             print(" !!! ERROR: Program surface failed!")
             print(" Done...")
@@ -422,37 +576,157 @@ class Respac:
         self.is_available(self.volm_out_name)
         self.is_available(self.surf_name)
 
-        pdcp_log   = " > " + self.out_dir + "/run/RESPAC.log 2>&1"
-        pdcp_args1 = ' --ifname '   + self.pdc_name      + ' --pqr ' + self.pqr_name
-        pdcp_args2 = ' --pot '      + self.apbs_out_name + ' --vol ' + self.volm_out_name
-        pdcp_args3 = ' --site All ' + ' --residue ' + self.surf_name
-        pdcp_args4 = ' --ofname '   + self.charge_name
-        pdcp_command = self.pdcp_exe + pdcp_args1 + pdcp_args2 + pdcp_args3 + pdcp_args4 + pdcp_log
+        pdcp_log   = self.out_dir + "/run/RESPAC.log"
+        pdcp_args1 = ['--ifname', self.pdc_name,      '--pqr', self.pqr_name]
+        pdcp_args2 = ['--pot',    self.apbs_out_name, '--vol', self.volm_out_name]
+        pdcp_args3 = ['--site',   'All',              '--residue', self.surf_name]
+        pdcp_args4 = ['--ofname', self.charge_name]
         try:
-            if self.verbose:
-                print(pdcp_command)
-            os.system(pdcp_command)
+            self.run_command(self.pdcp_exe, self.pdcp_exe_args + pdcp_args1 + pdcp_args2 + pdcp_args3 + pdcp_args4, pdcp_log)
         except:
             print(" !!! ERROR: Program pdcp failed!")
 
 
+    def read_charges(self, filename = None):
+        # Residue charges {resid: charge} from a pdcp output
+        if filename is None:
+            filename = self.charge_name
+
+        charges = {}
+        if not os.path.exists(filename):
+            return charges
+        with open(filename, 'r') as fin:
+            for line in fin:
+                words = line.split()
+                if len(words) < 2:
+                    continue
+                charges[int(words[0])] = float(words[1])
+        return charges
+
+
 
     def run_respac(self):
 
+        # Returns False if APBS failed and no charges were computed
         self.init()
         self.show_basic_settings()
-        self.run_pdb2pqr()
-        self.generate_apbs_inputs()
-        self.run_apbs()
-        self.run_surface()
-        self.generate_pdc_input()
-        self.run_pdc()
+        is_done = False
+        try:
+            self.run_pdb2pqr()
+            self.run_stage(self.run_surface)
+            is_done = self.run_grid_stages()
+        finally:
+            if self.thread_budget is not None:
+                self.thread_budget.finish_job()
 
         print("")
         print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
+        if not is_done:
+            print(" !!! ERROR: Calculation failed, see logs in {}/run".format(self.out_dir))
+            return False
         print(" Calculation finished! Please see results in {}".format(self.charge_name))
         print(" Additional results are also provided in tools.")
+        return True
+
+
+    def run_grid_stages(self):
+        # APBS and pdcp, the steps depending on apbs_grid_size
+        # Returns False if APBS failed, in which case pdcp is not run
+        self.generate_apbs_inputs()
+        if not self.run_stage(self.run_apbs):
+            print(" !!! ERROR: APBS failed with grid size {}; pdcp is skipped".format(self.apbs_grid_size))
+            return False
+
+        # Re-acquire so that pdcp gets the cores freed by finished jobs
+        self.run_stage(self.generate_pdc_input, self.run_pdc)
+        return True
+
+
+    def run_respac_adaptive(self):
+        # Coarse-to-fine: refine apbs_grid_size along adaptive_grid_sizes until
+        # residue charges change less than adaptive_charge_tol between levels.
+
+        self.init()
+        self.show_basic_settings()
+
+        print("")
+        print("============================================================")
+        print(" Adaptive grid: {}, tolerance = {}".format(self.adaptive_grid_sizes, self.adaptive_charge_tol))
+        print("============================================================")
+
+        # Each level writes its own <name>.<grid>.charge; the chosen one is
+        # copied to charge_name at the end.
+        charge_name    = self.charge_name
+        grid_size_orig = self.apbs_grid_size
+        if os.path.exists(charge_name):
+            os.remove(charge_name)
+
+        history = []
+        self.adaptive_grid_size = None
+        self.adaptive_residual  = None
+        self.adaptive_converged = False
+        try:
+            self.run_pdb2pqr()
+            self.run_stage(self.run_surface)
+
+            charges_prev = None
+            for grid_size in self.adaptive_grid_sizes:
+                self.apbs_grid_size = grid_size
+                self.charge_name = re.sub(r'\.charge$', '', charge_name) + '.{}.charge'.format(grid_size)
+                if os.path.exists(self.charge_name):
+                    os.remove(self.charge_name)
+                if not self.run_grid_stages():
+                    break
+
+                charges = self.read_charges()
+                if not charges:
+                    print(" !!! ERROR: No charges obtained with grid size {}".format(grid_size))
+                    break
 
+                residual = None
+                if charges_prev is not None:
+                    resids   = set(charges) | set(charges_prev)
+                    residual = max(abs(charges.get(i, 0.0) - charges_prev.get(i, 0.0)) for i in resids)
+                history.append((grid_size, residual, self.charge_name))
+                print(" Grid size {} : residual = {}".format(grid_size, residual))
+
+                if residual is not None and residual < self.adaptive_charge_tol:
+                    self.adaptive_converged = True
+                    break
+                charges_prev = charges
+        finally:
+            self.charge_name = charge_name
+            if self.thread_budget is not None:
+                self.thread_budget.finish_job()
+
+        if history:
+            self.adaptive_grid_size, self.adaptive_residual, level_charge_name = history[-1]
+            self.apbs_grid_size = self.adaptive_grid_size
+            shutil.copyfile(level_charge_name, self.charge_name)
+        else:
+            self.apbs_grid_size = grid_size_orig
+
+        with open(self.grid_log_name, 'w') as fout_grid:
+            fout_grid.write("# grid_size  residual\n")
+            for grid_size, residual, _ in history:
+                fout_grid.write("{:8.3f}  {}\n".format(grid_size, "-" if residual is None else "{:.6f}".format(residual)))
+            if history:
+                fout_grid.write("# chosen grid_size = {}, residual = {}, converged = {}\n".format(
+                    self.adaptive_grid_size, self.adaptive_residual, "yes" if self.adaptive_converged else "no"))
+            else:
+                fout_grid.write("# chosen grid_size = none, converged = no (all levels failed)\n")
+
+        print("")
+        print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
+        if not history:
+            print(" !!! ERROR: No grid size gave charges, see {}".format(self.grid_log_name))
+            return
+        if self.adaptive_converged:
+            print(" Calculation converged with grid size {} (residual = {})".format(self.adaptive_grid_size, self.adaptive_residual))
+        else:
+            print(" !!! WARNING: Not converged within tolerance {}; grid size {} used (residual = {})".format(
+                self.adaptive_charge_tol, self.adaptive_grid_size, self.adaptive_residual))
+        print(" Please see results in {} and {}".format(self.charge_name, self.grid_log_name))
 
 
 if __name__ == '__main__':
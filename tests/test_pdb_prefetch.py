@@ -0,0 +1,68 @@
+import gzip
+import os
+import sys
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pdb_prefetch import PDBMirror
+
+
+PDB_TEXT = b"ATOM      1  N   ALA A   1      11.104   6.134  -6.504  1.00  0.00           N\nEND\n"
+
+
+@pytest.fixture
+def server(tmp_path):
+    # Local HTTP server standing in for RCSB, recording the paths requested
+    srv_dir = tmp_path / 'srv'
+    srv_dir.mkdir()
+    (srv_dir / '1abc.pdb.gz').write_bytes(gzip.compress(PDB_TEXT))
+    (srv_dir / '1abc.pdb').write_bytes(PDB_TEXT)
+
+    requested = []
+
+    class Handler(SimpleHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.path)
+            super().do_GET()
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), partial(Handler, directory = str(srv_dir)))
+    thread = threading.Thread(target = httpd.serve_forever, daemon = True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(httpd.server_address[1]), requested
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.mark.parametrize('compressed', [True, False])
+def test_prefetch_refetch_and_export(tmp_path, server, compressed):
+    url, requested = server
+    mirror = PDBMirror(str(tmp_path / 'mirror'), base_url = url, compressed = compressed)
+    mirror.n_retries = 0
+
+    result = mirror.prefetch(['1abc', '1ABC', '9zzz'])
+    assert result['1abc'] is not None and result['1abc'] == result['1ABC']
+    assert result['9zzz'] is None
+    assert mirror.read('1abc') == PDB_TEXT
+    n_requested = len(requested)
+    assert n_requested == 2   # 1abc once, 9zzz once
+
+    # Already mirrored: no new download
+    mirror.prefetch(['1abc'])
+    assert len(requested) == n_requested
+
+    pdb_dir = tmp_path / 'pdb'
+    assert mirror.export('1abc', str(pdb_dir)) == str(pdb_dir / '1abc.pdb')
+    assert (pdb_dir / '1abc.pdb').read_bytes() == PDB_TEXT
+
+    # An existing input file is left as it is
+    (pdb_dir / '1abc.pdb').write_bytes(b"local\n")
+    mirror.export('1abc', str(pdb_dir))
+    assert (pdb_dir / '1abc.pdb').read_bytes() == b"local\n"
@@ -0,0 +1,203 @@
+import os
+import sys
+import stat
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from respac import Respac, ThreadBudget
+
+
+template_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../lib/template')
+
+PDB_TEXT = (
+    "ATOM      1  N   ALA A   1      11.104   6.134  -6.504  1.00  0.00           N\n"
+    "ATOM      2  CA  ALA A   2      15.104   9.134  -2.504  1.00  0.00           C\n"
+)
+
+# Stand-ins for the external programs. The stub apbs writes the grid
+# dimension into the potential, and the stub pdcp turns it into the charge
+# of residue 1 given by $STUB_CHARGE_<dime>. apbs dies like an OOM kill
+# when its dimension is listed in $STUB_APBS_FAIL.
+STUBS = {
+    'pdb2pqr30': '''#!/bin/sh
+for a; do prev=$last; last=$a; done
+cp "$prev" "$last"
+''',
+    'apbs': '''#!/bin/sh
+dime=$(awk '$1 == "dime" {print $2; exit}' "$1")
+case " $STUB_APBS_FAIL " in *" $dime "*) exit 137;; esac
+echo "  Ion Debye length = 7.8 A" > io.mc
+echo "$dime" > apbs_potential.dx
+touch vol_A.dx vol_B.dx
+''',
+    'dxmath': '''#!/bin/sh
+touch delta_vol.dx
+''',
+    'surface': '''#!/bin/sh
+while [ $# -gt 0 ]; do [ "$1" = "--ofname" ] && touch "$2"; shift; done
+''',
+    'pdcp': '''#!/bin/sh
+while [ $# -gt 0 ]; do
+    case "$1" in
+        --pot)    dime=$(cat "$2");;
+        --ofname) out=$2;;
+    esac
+    shift
+done
+eval charge=\\${STUB_CHARGE_$dime:-0.5}
+printf "1 %s\\n2 -1.0\\n" "$charge" > "$out"
+''',
+}
+
+
+# --------------------------------------------------------------------------------
+# ThreadBudget
+
+def test_thread_budget_split_follows_jobs_left():
+    budget = ThreadBudget(5, n_cores = 16, n_jobs = 4)
+    assert budget.acquire() == 4
+    budget.release()
+
+    for _ in range(3):
+        budget.finish_job()
+    assert budget.acquire() == 8
+    budget.release()
+
+    # The last job gets all cores
+    budget.finish_job()
+    assert budget.acquire() == 16
+    budget.release()
+
+
+def test_thread_budget_capped_by_active_stages():
+    budget = ThreadBudget(2, n_cores = 12, n_jobs = 2)
+    assert [budget.acquire() for _ in range(3)] == [6, 6, 4]
+    for _ in range(3):
+        budget.release()
+    assert budget.n_active == 0
+    assert budget.acquire() == 6
+
+
+def test_thread_budget_at_least_one_thread():
+    budget = ThreadBudget(8, n_cores = 2, n_jobs = 8)
+    assert budget.acquire() == 1
+
+
+# --------------------------------------------------------------------------------
+# Adaptive grid
+
+def write_stubs(bin_dir):
+    bin_dir.mkdir()
+    for name, text in STUBS.items():
+        exe = bin_dir / name
+        exe.write_text(text)
+        exe.chmod(exe.stat().st_mode | stat.S_IEXEC)
+
+
+@pytest.fixture
+def respac(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    write_stubs(bin_dir)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+
+    pdb_dir = tmp_path / 'pdb'
+    pdb_dir.mkdir()
+    (pdb_dir / 'p1.pdb').write_text(PDB_TEXT)
+
+    x = Respac('p1', pdb_dir = str(pdb_dir), out_dir = str(tmp_path / 'out'), template_dir = template_dir)
+    x.adaptive_grid_sizes = [1.0, 0.8, 0.6]
+    x.adaptive_charge_tol = 0.02
+    return x
+
+
+def dime(x, grid_size):
+    length_x, _, _ = x.measure_boxsize()
+    return int((length_x + x.apbs_box_margin) / grid_size)
+
+
+def set_charges(x, monkeypatch, charges):
+    for grid_size, charge in charges.items():
+        monkeypatch.setenv('STUB_CHARGE_{}'.format(dime(x, grid_size)), str(charge))
+
+
+def read_grid_log(x):
+    with open(x.grid_log_name) as fin:
+        return fin.read()
+
+
+def test_adaptive_converged(respac, monkeypatch):
+    set_charges(respac, monkeypatch, {1.0: 0.5, 0.8: 0.6, 0.6: 0.61})
+    respac.run_respac_adaptive()
+
+    assert respac.adaptive_converged
+    assert respac.adaptive_grid_size == 0.6
+    assert respac.adaptive_residual == pytest.approx(0.01)
+    assert respac.read_charges()[1] == pytest.approx(0.61)
+    assert "converged = yes" in read_grid_log(respac)
+
+
+def test_adaptive_not_converged(respac, monkeypatch):
+    set_charges(respac, monkeypatch, {1.0: 0.5, 0.8: 0.6, 0.6: 0.7})
+    respac.run_respac_adaptive()
+
+    assert not respac.adaptive_converged
+    assert respac.adaptive_grid_size == 0.6
+    assert respac.read_charges()[1] == pytest.approx(0.7)
+    assert "converged = no" in read_grid_log(respac)
+
+
+def test_adaptive_failing_level_is_not_converged(respac, monkeypatch):
+    # APBS dies at 0.8: the stale potential of 1.0 must not give residual 0
+    set_charges(respac, monkeypatch, {1.0: 0.5})
+    monkeypatch.setenv('STUB_APBS_FAIL', str(dime(respac, 0.8)))
+    respac.run_respac_adaptive()
+
+    assert not respac.adaptive_converged
+    assert respac.adaptive_grid_size == 1.0
+    assert respac.adaptive_residual is None
+    assert respac.read_charges()[1] == pytest.approx(0.5)
+    assert "converged = no" in read_grid_log(respac)
+
+
+def test_adaptive_all_levels_failed(respac, monkeypatch):
+    monkeypatch.setenv('STUB_APBS_FAIL', str(dime(respac, 1.0)))
+    respac.run_respac_adaptive()
+
+    assert respac.adaptive_grid_size is None
+    assert not respac.adaptive_converged
+    assert not os.path.exists(respac.charge_name)
+    assert "chosen grid_size = none" in read_grid_log(respac)
+
+
+# --------------------------------------------------------------------------------
+# Launching programs
+
+def test_paths_with_spaces_and_metacharacters(tmp_path):
+    # Programs and output directory with spaces and shell metacharacters
+    bin_dir = tmp_path / 'APBS 3.0 bin'
+    write_stubs(bin_dir)
+    pdb_dir = tmp_path / 'pdb'
+    pdb_dir.mkdir()
+    (pdb_dir / 'p1.pdb').write_text(PDB_TEXT)
+
+    x = Respac('p1', pdb_dir = str(pdb_dir), out_dir = str(tmp_path / 'o u;t $x'), template_dir = template_dir)
+    x.pqr_exe     = str(bin_dir / 'pdb2pqr30')
+    x.apbs_exe    = str(bin_dir / 'apbs')
+    x.dxmath_exe  = str(bin_dir / 'dxmath')
+    x.surface_exe = str(bin_dir / 'surface')
+    x.pdcp_exe    = str(bin_dir / 'pdcp')
+    assert x.run_respac()
+    assert x.read_charges() == {1: 0.5, 2: -1.0}
+
+
+def test_legacy_env_ldlib_path():
+    x = Respac('p1')
+    x.env_ldlib_path = "export LD_LIBRARY_PATH=/opt/apbs/lib/:/usr/lib/:$LD_LIBRARY_PATH; "
+    assert x.command_env()['LD_LIBRARY_PATH'].startswith("/opt/apbs/lib/:/usr/lib/")
+    assert "$LD_LIBRARY_PATH" not in x.command_env()['LD_LIBRARY_PATH']
+
+    x.env_ldlib_path = "source /opt/apbs/env.sh; "
+    with pytest.raises(ValueError):
+        x.command_env()
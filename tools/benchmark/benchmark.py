@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import queue
+import itertools
+import resource
+import multiprocessing
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../'))
+sys.dont_write_bytecode = True
+
+from respac import Respac
+
+
+template_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../lib/template')
+
+# High-resolution settings used as the reference charges
+reference = {
+    'apbs_grid_size'  : 0.3,
+    'apbs_box_margin' : 30.0,
+}
+
+# Parameter matrix: every combination is run for every protein
+# (each entry can be overridden from the command line as key=v1,v2,...)
+matrix = {
+    'apbs_grid_size'  : [1.0, 0.8, 0.6, 0.45],
+    'apbs_box_margin' : [10.0, 20.0],
+    'apbs_radius_A'   : [2.0, 3.0],
+    'apbs_radius_B'   : [10.0, 12.0],
+    'surface_dbox'    : [4.0, 6.0],
+    'surface_r_probe' : [3.0, 4.0],
+}
+
+
+def setting_label(setting):
+    return '_'.join('{}{}'.format(key, setting[key]) for key in sorted(setting))
+
+
+def run_one(pro_name, pdb_dir, out_dir, setting, result_queue):
+    # Runs in a child process so that peak memory of the tools is its own
+    x = Respac(pro_name, pdb_dir = pdb_dir, out_dir = out_dir, template_dir = template_dir)
+    for key, value in setting.items():
+        setattr(x, key, value)
+
+    # Charges left by an earlier run must not be taken as this run's
+    if os.path.exists(x.charge_name):
+        os.remove(x.charge_name)
+
+    t_start = time.time()
+    charges = {}
+    try:
+        # A failed APBS step gives no charges, never those of an earlier run
+        if x.run_respac():
+            charges = x.read_charges()
+    except Exception as e:
+        print(" !!! ERROR: {} failed with {}: {}".format(pro_name, setting_label(setting), e))
+    wall_time = time.time() - t_start
+
+    # ru_maxrss is in kB on Linux
+    peak_mem = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    result_queue.put((wall_time, peak_mem, charges))
+
+
+def run_setting(pro_name, pdb_dir, out_dir, setting):
+    # Returns (wall_time, peak_mem, charges); NaN and no charges if the child died
+    result_queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target = run_one, args = (pro_name, pdb_dir, out_dir, setting, result_queue))
+    proc.start()
+
+    result = None
+    while result is None:
+        try:
+            result = result_queue.get(timeout = 1.0)
+        except queue.Empty:
+            if proc.is_alive():
+                continue
+            # The child may have put its result just before exiting
+            try:
+                result = result_queue.get(timeout = 1.0)
+            except queue.Empty:
+                break
+    proc.join()
+
+    if result is None or proc.exitcode != 0:
+        print(" !!! ERROR: {} with {} died (exit code {})".format(pro_name, setting_label(setting), proc.exitcode))
+        return float('nan'), float('nan'), {}
+    return result
+
+
+def charge_error(charges, charges_ref):
+    # RMSE and max absolute error over residues of either set
+    if not charges or not charges_ref:
+        return float('nan'), float('nan')
+    resids = set(charges) | set(charges_ref)
+    diffs = [abs(charges.get(i, 0.0) - charges_ref.get(i, 0.0)) for i in resids]
+    rmse = (sum(d * d for d in diffs) / len(diffs)) ** 0.5
+    return rmse, max(diffs)
+
+
+def pareto_front(points):
+    # Indices of points not dominated in (cost, error), both minimized
+    front = []
+    for i, (c_i, e_i) in enumerate(points):
+        dominated = any(c_j <= c_i and e_j <= e_i and (c_j < c_i or e_j < e_i) for c_j, e_j in points)
+        if not dominated:
+            front.append(i)
+    return front
+
+
+def plot_pareto(rows, bench_dir):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    for cost, unit in [('wall_time', 's'), ('peak_mem', 'MB')]:
+        fig, ax = plt.subplots(figsize=(8, 6))
+        for pro_name in sorted(set(r['protein'] for r in rows)):
+            sub    = [r for r in rows if r['protein'] == pro_name and r['status'] == 'ok' and r['rmse'] == r['rmse']]
+            points = [(r[cost], r['rmse']) for r in sub]
+            front  = sorted(pareto_front(points), key=lambda i: points[i][0])
+            lines  = ax.plot([p[0] for p in points], [p[1] for p in points], 'o', alpha=0.5, label=pro_name)
+            ax.plot([points[i][0] for i in front], [points[i][1] for i in front], '-', color=lines[0].get_color())
+            for i in front:
+                ax.annotate(sub[i]['label'], points[i], fontsize=6)
+        ax.set_xlabel('{} [{}]'.format(cost, unit), size=14)
+        ax.set_ylabel('Charge RMSE', size=14)
+        ax.grid(color='gray', alpha=0.7, ls='--')
+        ax.legend()
+        plt.savefig(os.path.join(bench_dir, 'pareto_' + cost + '.png'), dpi=150)
+        plt.close(fig)
+
+
+def main(pdb_dir, bench_dir, pro_names):
+    pdb_dir   = os.path.abspath(pdb_dir)
+    bench_dir = os.path.abspath(bench_dir)
+    os.makedirs(bench_dir, exist_ok=True)
+
+    keys     = sorted(matrix)
+    settings = [dict(zip(keys, values)) for values in itertools.product(*[matrix[k] for k in keys])]
+
+    rows = []
+    for pro_name in pro_names:
+        # Reference charges, reused if already computed with the same settings
+        ref_dir = os.path.join(bench_dir, 'reference', setting_label(reference), pro_name)
+        x_ref = Respac(pro_name, out_dir = ref_dir)
+        charges_ref = x_ref.read_charges()
+        if not charges_ref:
+            _, _, charges_ref = run_setting(pro_name, pdb_dir, ref_dir, reference)
+        if not charges_ref:
+            print(" !!! ERROR: No reference charges for {}; errors are NaN".format(pro_name))
+
+        for setting in settings:
+            label = setting_label(setting)
+            out_dir = os.path.join(bench_dir, 'runs', pro_name, label)
+            wall_time, peak_mem, charges = run_setting(pro_name, pdb_dir, out_dir, setting)
+            rmse, max_err = charge_error(charges, charges_ref)
+
+            row = dict(setting)
+            row.update({'protein': pro_name, 'label': label, 'status': 'ok' if charges else 'failed', 'wall_time': wall_time,
+                        'peak_mem': peak_mem, 'rmse': rmse, 'max_err': max_err})
+            rows.append(row)
+
+    columns = ['protein'] + keys + ['status', 'wall_time', 'peak_mem', 'rmse', 'max_err']
+    table_name = os.path.join(bench_dir, 'benchmark.tsv')
+    with open(table_name, 'w') as fout:
+        fout.write('\t'.join(columns) + '\n')
+        for row in rows:
+            fout.write('\t'.join(str(row[c]) for c in columns) + '\n')
+    print(" Benchmark table: {}".format(table_name))
+
+    plot_pareto(rows, bench_dir)
+    print(" Pareto plots: {}/pareto_*.png".format(bench_dir))
+
+
+def parse_matrix(args):
+    # key=v1,v2,... entries replace those of matrix
+    for arg in args:
+        key, values = arg.split('=', 1)
+        if key not in matrix:
+            print(' !!! ERROR: Unknown parameter {} (one of {})'.format(key, ', '.join(sorted(matrix))))
+            sys.exit(1)
+        matrix[key] = [float(v) for v in values.split(',')]
+
+
+if __name__ == '__main__':
+    pro_names = [a for a in sys.argv[3:] if '=' not in a]
+    if len(sys.argv) < 4 or not pro_names:
+        print(' Usage: ', sys.argv[0], ' pdb_dir bench_dir pro_name [pro_name ...] [key=v1,v2,...]')
+        sys.exit(1)
+    parse_matrix([a for a in sys.argv[3:] if '=' in a])
+    main(sys.argv[1], sys.argv[2], pro_names)